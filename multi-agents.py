@@ -1,17 +1,144 @@
+import inspect
+import json
 import os
 import re
-from typing import Any, Dict, List
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
 
 import matplotlib.pyplot as plt
 import pandas as pd
 import requests
 from markdownify import markdownify
 from requests.exceptions import RequestException
-from smolagents import (CodeAgent, DuckDuckGoSearchTool, OpenAIServerModel,
-                        ToolCallingAgent, tool)
+from smolagents import (AgentLogger, CodeAgent, DuckDuckGoSearchTool, LogLevel,
+                        Model, OpenAIServerModel, ToolCallingAgent, tool)
+from smolagents.memory import (ActionStep, PlanningStep, SystemPromptStep,
+                               TaskStep, ToolCall)
+from smolagents.utils import (AgentError, AgentExecutionError,
+                              AgentGenerationError, AgentMaxStepsError,
+                              AgentParsingError)
 
 
 # Web browsing tool
+def fetch_markdown(url: str, timeout: Optional[float] = None) -> str:
+    """Downloads a webpage and converts it to Markdown, raising on request errors."""
+    # Send a GET request to the URL
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()  # Raise an exception for bad status codes
+
+    # Convert the HTML content to Markdown
+    markdown_content = markdownify(response.text).strip()
+
+    # Remove multiple line breaks
+    return re.sub(r"\n{3,}", "\n\n", markdown_content)
+
+class PagePrefetcher:
+    """
+    Fetches and converts search-result pages in the background so later page visits are served from memory.
+
+    Pages are buffered in the order they were scheduled. Once the converted Markdown exceeds
+    `max_buffer_chars`, the oldest unconsumed pages are evicted. Failed fetches, and fetches
+    that have not started yet when the page is visited, are dropped so the visit falls back
+    to a live request.
+
+    Args:
+        max_workers: Maximum number of pages fetched concurrently
+        max_buffer_chars: Upper bound on the total size of buffered Markdown
+        fetch_timeout: Timeout in seconds for each background request
+    """
+
+    def __init__(self, max_workers: int = 4, max_buffer_chars: int = 2_000_000, fetch_timeout: float = 15.0):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="page-prefetch")
+        self.max_buffer_chars = max_buffer_chars
+        self.fetch_timeout = fetch_timeout
+        self.pages: "OrderedDict[str, Future]" = OrderedDict()
+        self.page_sizes: Dict[str, int] = {}
+        self.buffered_chars = 0
+        self.lock = threading.RLock()
+        self.stats = {"scheduled": 0, "hits": 0, "misses": 0, "evicted": 0}
+
+    def prefetch(self, urls: List[str]):
+        """Schedules background fetches for URLs that are not already buffered."""
+        with self.lock:
+            for url in urls:
+                if url in self.pages:
+                    continue
+                future = self.executor.submit(fetch_markdown, url, self.fetch_timeout)
+                self.pages[url] = future
+                self.stats["scheduled"] += 1
+                future.add_done_callback(lambda done, url=url: self._on_fetched(url, done))
+
+    def _on_fetched(self, url: str, future: Future):
+        with self.lock:
+            # The page was consumed or evicted while it was still downloading
+            if self.pages.get(url) is not future:
+                return
+            if future.cancelled() or future.exception() is not None:
+                del self.pages[url]
+                return
+
+            self.page_sizes[url] = len(future.result())
+            self.buffered_chars += self.page_sizes[url]
+            for buffered_url in list(self.page_sizes):
+                if self.buffered_chars <= self.max_buffer_chars:
+                    break
+                self._evict(buffered_url)
+
+    def _evict(self, url: str):
+        self.pages.pop(url, None)
+        self.buffered_chars -= self.page_sizes.pop(url, 0)
+        self.stats["evicted"] += 1
+
+    def pop(self, url: str) -> Optional[str]:
+        """Returns the prefetched Markdown for a URL, waiting for it if already downloading, or None on a miss."""
+        with self.lock:
+            future = self.pages.pop(url, None)
+            self.buffered_chars -= self.page_sizes.pop(url, 0)
+            # A fetch still queued behind other prefetches is no faster than a live request
+            if future is None or future.cancel():
+                self.stats["misses"] += 1
+                return None
+
+        try:
+            content = future.result(timeout=self.fetch_timeout)
+        except Exception:
+            content = None
+        with self.lock:
+            self.stats["hits" if content is not None else "misses"] += 1
+        return content
+
+    def clear(self):
+        """Cancels pending fetches and evicts every unconsumed page."""
+        with self.lock:
+            for url, future in list(self.pages.items()):
+                future.cancel()
+                self._evict(url)
+
+    def shutdown(self):
+        """Evicts every page and stops the worker threads, so exiting only waits for fetches already running."""
+        self.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+page_prefetcher = PagePrefetcher()
+
+class PrefetchingSearchTool(DuckDuckGoSearchTool):
+    """DuckDuckGo search that starts downloading the top result pages as soon as the results come back."""
+
+    def __init__(self, prefetcher: PagePrefetcher, top_k: int = 3, **kwargs):
+        super().__init__(**kwargs)
+        self.prefetcher = prefetcher
+        self.top_k = top_k
+
+    def forward(self, query: str) -> str:
+        results = super().forward(query)
+        # Each result is formatted as "[title](url)" followed by its snippet on the next line
+        urls = re.findall(r"\]\((https?://\S+)\)\n", results)
+        self.prefetcher.prefetch(urls[: self.top_k])
+        return results
+
 @tool
 def visit_webpage(url: str) -> str:
     """Visits a webpage at the given URL and returns its content as a markdown string.
@@ -23,15 +150,10 @@ def visit_webpage(url: str) -> str:
         The content of the webpage converted to Markdown, or an error message if the request fails.
     """
     try:
-        # Send a GET request to the URL
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for bad status codes
-
-        # Convert the HTML content to Markdown
-        markdown_content = markdownify(response.text).strip()
-
-        # Remove multiple line breaks
-        markdown_content = re.sub(r"\n{3,}", "\n\n", markdown_content)
+        # Serve pages already downloaded after a search, otherwise fetch live
+        markdown_content = page_prefetcher.pop(url)
+        if markdown_content is None:
+            markdown_content = fetch_markdown(url)
 
         return markdown_content
 
@@ -110,6 +232,547 @@ def extract_key_metrics(text: str) -> Dict[str, Any]:
     
     return metrics
 
+# Model routing
+def _message_text(message) -> str:
+    """Returns the plain text of a chat message, whether its content is a string or a list of parts."""
+    content = message["content"] if isinstance(message, dict) else getattr(message, "content", "")
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+def _is_planning_call(stop_sequences: Optional[List[str]]) -> bool:
+    """Action steps always pass stop sequences; fact updates pass none and plans stop on <end_plan>."""
+    return not stop_sequences or "<end_plan>" in stop_sequences
+
+class RoutingModel(Model):
+    """
+    Sends each model call to a fast or a strong model based on simple routing rules.
+
+    Rules are checked in order: an optional custom `route_fn`, then planning calls,
+    the step right after an error, an unreliable fast model and oversized prompts all
+    go to the strong model. Every other (routine) step goes to the fast model. If the
+    fast model raises, the call is retried on the strong model.
+
+    The fast model counts as unreliable while it has too many failures among the last
+    `outcome_window` routed steps. Register `record_step` as a step callback of the agent
+    so that steps ending in an error (bad code, wrong tool calls) count as failures of the
+    route that produced them. Steps served by the strong model push old failures out of
+    the window, so the fast route is tried again later.
+
+    Only `__call__` and the `last_*_token_count` attributes of the wrapped models are
+    used, so any local stand-in model with that interface can be routed as well.
+
+    Args:
+        fast_model: Low-latency model used for routine steps
+        strong_model: Slower reasoning model used for planning and hard steps
+        max_fast_prompt_chars: Prompts longer than this are sent to the strong model
+        plan_with_strong: Send planning calls (facts and plan updates) to the strong model
+        escalate_on_error: Send the step that follows a failed step to the strong model
+        max_fast_failures: Stop using the fast model while it has this many failures in the window
+        outcome_window: Number of recent routed steps considered for `max_fast_failures`
+        route_fn: Optional callable `(messages, stop_sequences) -> "fast" | "strong" | None`,
+            checked before the built-in rules. Returning None falls through to them.
+    """
+
+    def __init__(
+        self,
+        fast_model: Model,
+        strong_model: Model,
+        max_fast_prompt_chars: int = 20000,
+        plan_with_strong: bool = True,
+        escalate_on_error: bool = True,
+        max_fast_failures: int = 3,
+        outcome_window: int = 6,
+        route_fn: Optional[Callable[[List[Dict[str, Any]], Optional[List[str]]], Optional[str]]] = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.models = {"fast": fast_model, "strong": strong_model}
+        self.model_id = f"router({getattr(fast_model, 'model_id', 'fast')}|{getattr(strong_model, 'model_id', 'strong')})"
+        self.max_fast_prompt_chars = max_fast_prompt_chars
+        self.plan_with_strong = plan_with_strong
+        self.escalate_on_error = escalate_on_error
+        self.max_fast_failures = max_fast_failures
+        self.route_fn = route_fn
+        self.route_stats = {
+            route: {"calls": 0, "errors": 0, "failed_steps": 0, "seconds": 0.0, "input_tokens": 0, "output_tokens": 0}
+            for route in self.models
+        }
+        self.route_log = []
+        self.last_model_id = None
+        self.recent_outcomes = deque(maxlen=outcome_window)  # (route, succeeded) per routed step
+        self.step_route = None
+
+    def choose_route(self, messages: List[Dict[str, Any]], stop_sequences: Optional[List[str]] = None):
+        """Returns the route ("fast" or "strong") for a call, along with the rule that picked it."""
+        if self.route_fn is not None:
+            route = self.route_fn(messages, stop_sequences)
+            if route is not None:
+                return route, "custom"
+
+        if self.plan_with_strong and _is_planning_call(stop_sequences):
+            return "strong", "planning"
+
+        last_text = _message_text(messages[-1]) if messages else ""
+        if self.escalate_on_error and "Error:" in last_text and "Now let's retry" in last_text:
+            return "strong", "after_error"
+
+        fast_failures = sum(1 for route, succeeded in self.recent_outcomes if route == "fast" and not succeeded)
+        if fast_failures >= self.max_fast_failures:
+            return "strong", "fast_unreliable"
+
+        if sum(len(_message_text(message)) for message in messages) > self.max_fast_prompt_chars:
+            return "strong", "prompt_size"
+
+        return "fast", "routine"
+
+    def _call_route(self, route: str, reason: str, messages, stop_sequences, **kwargs):
+        model = self.models[route]
+        stats = self.route_stats[route]
+        stats["calls"] += 1
+        log_entry = {"route": route, "reason": reason, "model_id": getattr(model, "model_id", route), "failed": False}
+        start_time = time.perf_counter()
+        try:
+            response = model(messages, stop_sequences=stop_sequences, **kwargs)
+        except Exception:
+            stats["errors"] += 1
+            log_entry["failed"] = True
+            raise
+        finally:
+            log_entry["seconds"] = time.perf_counter() - start_time
+            stats["seconds"] += log_entry["seconds"]
+            self.route_log.append(log_entry)
+
+        self.last_input_token_count = model.last_input_token_count
+        self.last_output_token_count = model.last_output_token_count
+        self.last_model_id = log_entry["model_id"]
+        stats["input_tokens"] += self.last_input_token_count or 0
+        stats["output_tokens"] += self.last_output_token_count or 0
+        log_entry["input_tokens"] = self.last_input_token_count
+        log_entry["output_tokens"] = self.last_output_token_count
+        return response
+
+    def __call__(self, messages: List[Dict[str, Any]], stop_sequences: Optional[List[str]] = None, **kwargs):
+        route, reason = self.choose_route(messages, stop_sequences)
+        is_action = not _is_planning_call(stop_sequences)
+        try:
+            response = self._call_route(route, reason, messages, stop_sequences, **kwargs)
+        except Exception:
+            if route != "fast":
+                raise
+            response = self._call_route("strong", "fast_failed", messages, stop_sequences, **kwargs)
+            if is_action:
+                # The step counts as a fast failure only, so the strong retry cannot push it out of the window
+                self.recent_outcomes.append(("fast", False))
+                self.step_route = None
+            return response
+
+        if is_action:
+            self.step_route = route
+        return response
+
+    def record_step(self, memory_step, agent=None):
+        """Step callback that records whether the step produced by the routed action call succeeded."""
+        if self.step_route is None:
+            return
+        succeeded = getattr(memory_step, "error", None) is None
+        if not succeeded:
+            self.route_stats[self.step_route]["failed_steps"] += 1
+        self.recent_outcomes.append((self.step_route, succeeded))
+        self.step_route = None
+
+    def stats_table(self) -> pd.DataFrame:
+        """Returns per-route call counts, errors, latency and token usage."""
+        table = pd.DataFrame(self.route_stats).T
+        table["avg_seconds"] = table["seconds"] / table["calls"].where(table["calls"] > 0)
+        return table
+
+# Prompt caching
+def _canonical_text(text: str) -> str:
+    """Normalizes line endings, trailing spaces and blank lines so identical prompts are byte-identical."""
+    text = "\n".join(line.rstrip() for line in text.replace("\r\n", "\n").split("\n"))
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+def stabilize_prompt_prefix(agent):
+    """
+    Sorts the tools, managed agents and authorized imports an agent renders into its system prompt.
+
+    The system prompt is rebuilt from these on every run, so sorting them keeps the prompt prefix
+    identical across runs and processes (authorized imports come from a set, whose order varies).
+    Managed agents are stabilized recursively.
+
+    Args:
+        agent: The agent whose prompt inputs should be sorted
+    """
+    agent.tools = dict(sorted(agent.tools.items()))
+    agent.managed_agents = dict(sorted(agent.managed_agents.items()))
+    if hasattr(agent, "authorized_imports"):
+        agent.authorized_imports = sorted(agent.authorized_imports)
+    for managed_agent in agent.managed_agents.values():
+        stabilize_prompt_prefix(managed_agent)
+
+class PromptCacheModel(Model):
+    """
+    Wraps a model to keep the static prompt prefix byte-identical and report provider prompt-cache usage.
+
+    With `canonicalize` on, the leading system messages are whitespace-normalized and the tools
+    passed for tool calling are sorted by name, so every step starts with the same prefix and the
+    dynamic tail (task, memory, observations) follows it. Cached prompt tokens are read from the
+    OpenAI usage details of each response and logged per call, along with the kind of call
+    (planning, action or the final answer forced after max steps) and the model that served it.
+    Register `record_step` as a step callback of the agent to tag each call with its run index
+    and step number.
+
+    Args:
+        model: The model to wrap
+        canonicalize: Canonicalize the static prefix before each call
+    """
+
+    def __init__(self, model: Model, canonicalize: bool = True, **kwargs):
+        super().__init__(**kwargs)
+        self.model = model
+        self.model_id = getattr(model, "model_id", None)
+        self.canonicalize = canonicalize
+        self.cache_log = []
+        self.run_index = 0
+        self.last_step = 0
+
+    def _canonical_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        canonical_messages = []
+        in_prefix = True
+        for message in messages:
+            in_prefix = in_prefix and message["role"] == "system"
+            if in_prefix and isinstance(message["content"], list):
+                message = {**message, "content": [
+                    {**part, "text": _canonical_text(part["text"])} if part.get("type") == "text" else part
+                    for part in message["content"]
+                ]}
+            elif in_prefix:
+                message = {**message, "content": _canonical_text(message["content"])}
+            canonical_messages.append(message)
+        return canonical_messages
+
+    def __call__(self, messages: List[Dict[str, Any]], stop_sequences: Optional[List[str]] = None,
+                 tools_to_call_from=None, **kwargs):
+        if self.canonicalize:
+            messages = self._canonical_messages(messages)
+            if tools_to_call_from:
+                tools_to_call_from = sorted(tools_to_call_from, key=lambda tool: tool.name)
+
+        response = self.model(messages, stop_sequences=stop_sequences, tools_to_call_from=tools_to_call_from, **kwargs)
+        self.last_input_token_count = self.model.last_input_token_count
+        self.last_output_token_count = self.model.last_output_token_count
+
+        usage = getattr(getattr(response, "raw", None), "usage", None)
+        cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None) or 0
+        input_tokens = self.last_input_token_count or 0
+        self.cache_log.append({
+            "call": len(self.cache_log) + 1,
+            "run": None,
+            "step": None,
+            "kind": "planning" if _is_planning_call(stop_sequences) else "action",
+            # Routing models report which underlying model served the call; caches are per model
+            "model_id": getattr(self.model, "last_model_id", None) or self.model_id,
+            "input_tokens": input_tokens,
+            "cached_tokens": cached_tokens,
+            "uncached_tokens": input_tokens - cached_tokens,
+        })
+        return response
+
+    def record_step(self, memory_step, agent=None):
+        """Step callback that tags the calls made during the step with its run index and step number."""
+        # Step numbers restart at 1 for each run, e.g. every time a managed agent is called
+        if self.run_index == 0 or memory_step.step_number <= self.last_step:
+            self.run_index += 1
+        self.last_step = memory_step.step_number
+
+        for entry in reversed(self.cache_log):
+            if entry["step"] is not None:
+                break
+            entry["run"] = self.run_index
+            entry["step"] = memory_step.step_number
+            # The forced answer after max steps passes no stop sequences, like planning calls
+            if isinstance(memory_step.error, AgentMaxStepsError):
+                entry["kind"] = "final_answer"
+
+    def cache_table(self) -> pd.DataFrame:
+        """Returns cached vs uncached prompt tokens and the cache hit rate for each model call."""
+        table = pd.DataFrame(self.cache_log, columns=[
+            "call", "run", "step", "kind", "model_id", "input_tokens", "cached_tokens", "uncached_tokens"
+        ])
+        table["hit_rate"] = table["cached_tokens"] / table["input_tokens"].where(table["input_tokens"] > 0)
+        return table
+
+# Checkpointing
+AGENT_ERROR_TYPES = {
+    error_type.__name__: error_type
+    for error_type in (AgentParsingError, AgentExecutionError, AgentMaxStepsError, AgentGenerationError)
+}
+
+class ResumableCodeAgent(CodeAgent):
+    """
+    CodeAgent that can continue a run whose completed steps were restored into its memory.
+
+    `_run` always restarts counting at step 1, which would redo the initial planning and renumber
+    the steps. While `step_offset` is set, that first step is shifted past the restored steps, so
+    plan updates and `max_steps` follow the numbering of the interrupted run. The code of the
+    restored steps is run again first, so the variables it defined exist in the interpreter.
+    """
+
+    step_offset = 0
+
+    @property
+    def step_number(self) -> int:
+        return self._step_number
+
+    @step_number.setter
+    def step_number(self, value: int):
+        self._step_number = value + self.step_offset if value == 1 else value
+
+    def resume(self, task: str, last_step: int):
+        """
+        Continues a run after its last completed step, without adding a new task step to memory.
+
+        Args:
+            task: The task of the interrupted run
+            last_step: Number of the last completed step restored into memory
+
+        Returns:
+            The final answer of the run
+        """
+        self.task = task
+        self.system_prompt = self.initialize_system_prompt()
+        self.memory.system_prompt = SystemPromptStep(system_prompt=self.system_prompt)
+        self.replay_code()
+
+        # All steps are spent; only the final answer of the interrupted run is missing
+        if last_step >= self.max_steps:
+            return self._finish_after_max_steps(last_step + 1)
+
+        self.step_offset = last_step
+        try:
+            return deque(self._run(task=self.task), maxlen=1)[0]
+        finally:
+            self.step_offset = 0
+
+    def _finish_after_max_steps(self, step_number: int):
+        # Mirrors the end of `_run` when the step budget runs out
+        start_time = time.time()
+        final_answer = self.provide_final_answer(self.task, None)
+        end_time = time.time()
+        final_step = ActionStep(
+            step_number=step_number,
+            start_time=start_time,
+            end_time=end_time,
+            duration=end_time - start_time,
+            error=AgentMaxStepsError("Reached max steps.", self.logger),
+            action_output=final_answer,
+        )
+        self.memory.steps.append(final_step)
+        for callback in self.step_callbacks:
+            if len(inspect.signature(callback).parameters) == 1:
+                callback(final_step)
+            else:
+                callback(final_step, agent=self)
+        return final_answer
+
+    def replay_code(self):
+        """Runs the code of the action steps in memory again to rebuild the interpreter's variables."""
+        for step in self.memory.steps:
+            if not isinstance(step, ActionStep) or not step.tool_calls:
+                continue
+            try:
+                self.python_executor(step.tool_calls[0].arguments, self.state)
+            except Exception:
+                pass  # The step's error is already part of its memory
+
+class RunCheckpoint:
+    """
+    Appends agent memory steps and managed-agent outputs to a JSON-lines log so an interrupted run can resume.
+
+    Each completed step of the attached agent is written as soon as it finishes, together with the
+    output of every managed-agent call. Resuming rebuilds the memory up to the last completed step,
+    and every logged sub-agent output is replayed once, in order, instead of running the sub-agent
+    again. This serves both the re-run code of completed steps and the calls the interrupted step
+    already paid for. A log whose run finished, or that belongs to a different task, is replaced
+    by a fresh run. Large model inputs are not stored since they are rebuilt from memory.
+
+    Args:
+        checkpoint_dir: Directory holding one log file per run
+    """
+
+    def __init__(self, checkpoint_dir: str = "checkpoints"):
+        self.checkpoint_dir = checkpoint_dir
+        self.path = None
+        self.records = []
+        self.logged_steps = 0
+        self.replay_outputs: Dict[str, List[str]] = {}
+        # Restored errors were already reported by the interrupted run
+        self.silent_logger = AgentLogger(level=LogLevel.OFF)
+
+    def open(self, run_id: str, task: str, resume: bool = True) -> str:
+        """Selects the log for a run, loading it when resuming an unfinished run of the same task and starting a new one otherwise."""
+        slug = re.sub(r"\W+", "-", run_id.lower()).strip("-_")
+        if not slug:
+            raise ValueError(f"Run id {run_id!r} has no letters or digits to name its checkpoint log")
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        self.path = os.path.join(self.checkpoint_dir, f"{slug}.jsonl")
+        self.records = []
+        self.logged_steps = 0
+        self.replay_outputs = {}
+
+        if resume and os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        self.records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break  # A crash mid-write leaves a truncated last line
+            logged_tasks = [record["task"] for record in self.records if record.get("kind") == "task"]
+            if logged_tasks[:1] not in ([], [task]) or any(record["type"] == "final" for record in self.records):
+                self.records = []
+
+        self._write(self.records)
+        return self.path
+
+    def _write(self, records: List[Dict[str, Any]]):
+        with open(self.path, "w") as f:
+            f.writelines(json.dumps(record, default=str) + "\n" for record in records)
+
+    def _append(self, record: Dict[str, Any]):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+    def log_steps(self, memory_step, agent=None):
+        """Step callback that writes every memory step added since the last call."""
+        if self.path is None or agent is None:
+            return
+        for step in agent.memory.steps[self.logged_steps:]:
+            if isinstance(step, TaskStep):
+                self._append({"type": "step", "kind": "task", "task": step.task})
+            elif isinstance(step, PlanningStep):
+                self._append({"type": "step", "kind": "planning", "facts": step.facts, "plan": step.plan})
+            elif isinstance(step, ActionStep) and (step.model_output is not None or step.error is not None):
+                self._append({
+                    "type": "step",
+                    "kind": "action",
+                    "step_number": step.step_number,
+                    "start_time": step.start_time,
+                    "end_time": step.end_time,
+                    "duration": step.duration,
+                    "model_output": step.model_output,
+                    "tool_calls": [{"name": tool_call.name, "arguments": tool_call.arguments, "id": tool_call.id}
+                                   for tool_call in step.tool_calls or []],
+                    "observations": step.observations,
+                    "error": step.error.dict() if step.error is not None else None,
+                    "action_output": step.action_output,
+                })
+        self.logged_steps = len(agent.memory.steps)
+
+    def log_final_answer(self, final_answer: Any):
+        self._append({"type": "final", "output": str(final_answer)})
+
+    def restore(self, agent) -> int:
+        """
+        Rebuilds the agent's memory from the logged steps.
+
+        Steps logged after the last completed action step, such as the plan of the interrupted step,
+        are dropped because that step runs again. All managed-agent outputs are kept for replay.
+
+        Args:
+            agent: The agent whose memory is restored
+
+        Returns:
+            The number of the last completed step, or 0 if there is nothing to resume
+        """
+        action_indices = [index for index, record in enumerate(self.records)
+                          if record["type"] == "step" and record["kind"] == "action"]
+        last_action = action_indices[-1] if action_indices else -1
+        for record in self.records:
+            if record["type"] == "managed":
+                self.replay_outputs.setdefault(f"{record['agent']}\n{record['task']}", []).append(record["output"])
+
+        self.records = [record for index, record in enumerate(self.records)
+                        if record["type"] != "step" or index <= last_action]
+        self._write(self.records)
+
+        steps = []
+        for record in self.records:
+            if record["type"] != "step":
+                continue
+            if record["kind"] == "task":
+                steps.append(TaskStep(task=record["task"]))
+            elif record["kind"] == "planning":
+                steps.append(PlanningStep(
+                    model_input_messages=[],
+                    model_output_message_facts=None,
+                    facts=record["facts"],
+                    model_output_message_plan=None,
+                    plan=record["plan"],
+                ))
+            else:
+                error = record["error"]
+                steps.append(ActionStep(
+                    step_number=record["step_number"],
+                    start_time=record["start_time"],
+                    end_time=record["end_time"],
+                    duration=record["duration"],
+                    model_output=record["model_output"],
+                    tool_calls=[ToolCall(name=call["name"], arguments=call["arguments"], id=call["id"])
+                                for call in record["tool_calls"]],
+                    observations=record["observations"],
+                    error=AGENT_ERROR_TYPES.get(error["type"], AgentError)(error["message"], self.silent_logger)
+                    if error else None,
+                    action_output=record["action_output"],
+                ))
+
+        self.logged_steps = len(steps)
+        if not steps:
+            return 0
+        agent.memory.reset()
+        agent.memory.steps.extend(steps)
+        return self.records[last_action]["step_number"]
+
+    def run(self, agent: ResumableCodeAgent, task: str, run_id: str, resume: bool = True):
+        """
+        Runs an agent on a task while logging its steps, continuing an unfinished logged run when resuming.
+
+        Args:
+            agent: The agent to run, with `log_steps` registered as a step callback
+            task: The task to perform
+            run_id: Name of the run, used for the log file name
+            resume: Continue the last unfinished run logged under `run_id`
+
+        Returns:
+            The final answer of the run
+        """
+        self.open(run_id, task, resume=resume)
+        last_step = self.restore(agent)
+        if last_step:
+            result = agent.resume(task, last_step)
+        else:
+            result = agent.run(task)
+        self.log_final_answer(result)
+        return result
+
+    def cache_managed_agents(self, agent):
+        """Logs the outputs of the agent's managed agents and replays the logged ones when resuming."""
+        for managed_agent in agent.managed_agents.values():
+            managed_agent.run = self._cached_run(managed_agent.name, managed_agent.run)
+
+    def _cached_run(self, name: str, run: Callable):
+        def cached_run(task: str, *args, **kwargs):
+            replay_outputs = self.replay_outputs.get(f"{name}\n{task}")
+            if replay_outputs:
+                return replay_outputs.pop(0)
+            output = run(task, *args, **kwargs)
+            if self.path is not None:
+                self._append({"type": "managed", "agent": name, "task": task, "output": str(output)})
+            return output
+        return cached_run
+
+run_checkpoint = RunCheckpoint()
+
 # Initialize the OpenAI models
 web_model = OpenAIServerModel(
     model_id="gpt-4o-mini-2024-07-18",
@@ -123,12 +786,23 @@ reasoning_model = OpenAIServerModel(
     api_key=os.environ["OPENAI_API_KEY"],
 )
 
+# Routine steps (tool calls, final answers) go to the fast model; planning and recovery to the reasoning model
+analysis_router = RoutingModel(fast_model=web_model, strong_model=reasoning_model)
+manager_router = RoutingModel(fast_model=web_model, strong_model=reasoning_model)
+
+# Keep the system prompt and tool list identical on every step so provider prompt caching applies
+STABLE_PROMPT_PREFIX = True
+web_cache_model = PromptCacheModel(web_model, canonicalize=STABLE_PROMPT_PREFIX)
+analysis_cache_model = PromptCacheModel(analysis_router, canonicalize=STABLE_PROMPT_PREFIX)
+manager_cache_model = PromptCacheModel(manager_router, canonicalize=STABLE_PROMPT_PREFIX)
+
 # Create specialized agents
 # 1. Web Search Agent - for retrieving market information
 web_agent = ToolCallingAgent(
-    tools=[DuckDuckGoSearchTool(), visit_webpage],
-    model=web_model,
+    tools=[PrefetchingSearchTool(page_prefetcher, top_k=3), visit_webpage],
+    model=web_cache_model,
     max_steps=8,
+    step_callbacks=[web_cache_model.record_step],
     name="web_search_agent",
     description="Searches the web for recent market data and news about specific industries.",
 )
@@ -136,15 +810,16 @@ web_agent = ToolCallingAgent(
 # 2. Analysis Agent - for processing information
 analysis_agent = ToolCallingAgent(
     tools=[analyze_sentiment, extract_key_metrics],
-    model=reasoning_model,
+    model=analysis_cache_model,
     max_steps=5,
+    step_callbacks=[analysis_router.record_step, analysis_cache_model.record_step],
     name="analysis_agent",
     description="Analyzes market data to extract sentiment and key metrics",
 )
 
 # 3. Manager Agent - orchestrates the entire process
-manager_agent = CodeAgent(
-    model=reasoning_model,
+manager_agent = ResumableCodeAgent(
+    model=manager_cache_model,
     tools=[],
     managed_agents=[web_agent, analysis_agent],
     additional_authorized_imports=["pandas", "matplotlib.pyplot"],
@@ -152,20 +827,25 @@ manager_agent = CodeAgent(
     description="Manages the market research workflow and compiles the final report",
     planning_interval=2,
     max_steps=12,
-    verbosity_level=2
+    verbosity_level=2,
+    step_callbacks=[run_checkpoint.log_steps, manager_router.record_step, manager_cache_model.record_step],
 )
+run_checkpoint.cache_managed_agents(manager_agent)
+if STABLE_PROMPT_PREFIX:
+    stabilize_prompt_prefix(manager_agent)
 
 # Display the agent hierarchy
 def visualize_agent_system():
     manager_agent.visualize()
 
 # Example usage function
-def run_market_research(industry: str):
+def run_market_research(industry: str, resume: bool = True):
     """
     Generate a market research report for a specific industry.
     
     Args:
         industry: The industry to research
+        resume: Continue from the last completed step if the previous run for this industry was interrupted
         
     Returns:
         A market research report with insights and analysis
@@ -184,7 +864,11 @@ def run_market_research(industry: str):
     The report should be concise but comprehensive, focusing on actionable insights. Also include sources at the end of report from where you got the data.
     """
     
-    result = manager_agent.run(prompt)
+    try:
+        result = run_checkpoint.run(manager_agent, prompt, run_id=industry, resume=resume)
+    finally:
+        # Drop pages that were prefetched but never visited
+        page_prefetcher.clear()
     return result
 
 # Usage example
@@ -195,7 +879,19 @@ if __name__ == "__main__":
     # Run a market research for the renewable energy industry
     report = run_market_research("defence industry")
     print(report)
+
+    # Show how many steps each agent routed to the fast and the reasoning model
+    print("Manager routing:\n", manager_router.stats_table())
+    print("Analysis routing:\n", analysis_router.stats_table())
+
+    # Show how much of each prompt was served from the provider's prompt cache
+    print("Manager prompt cache:\n", manager_cache_model.cache_table())
+    print("Web search prompt cache:\n", web_cache_model.cache_table())
+    print("Analysis prompt cache:\n", analysis_cache_model.cache_table())
     
     # You can easily run research for other industries
     # report = run_market_research("electric vehicles")
-    # report = run_market_research("artificial intelligence")
\ No newline at end of file
+    # report = run_market_research("artificial intelligence")
+
+    # Stop the prefetch workers so the interpreter doesn't wait on leftover downloads at exit
+    page_prefetcher.shutdown()
@@ -0,0 +1,461 @@
+import json
+import os
+import runpy
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from requests.exceptions import RequestException
+from smolagents import CodeAgent, LogLevel, Model
+from smolagents.memory import ActionStep, PlanningStep, TaskStep
+from smolagents.models import ChatMessage
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+multi_agents = runpy.run_path(str(Path(__file__).parent.parent / "multi-agents.py"))
+PagePrefetcher = multi_agents["PagePrefetcher"]
+PrefetchingSearchTool = multi_agents["PrefetchingSearchTool"]
+PromptCacheModel = multi_agents["PromptCacheModel"]
+ResumableCodeAgent = multi_agents["ResumableCodeAgent"]
+RoutingModel = multi_agents["RoutingModel"]
+RunCheckpoint = multi_agents["RunCheckpoint"]
+
+ACTION_STOP = ["Observation:"]
+
+
+class ScriptedModel(Model):
+    """Stand-in model that answers planning calls, prints on action calls and gives a final answer on `final_call`."""
+
+    def __init__(self, final_call: int, crash_call: int = None):
+        super().__init__()
+        self.model_id = "scripted"
+        self.final_call = final_call
+        self.crash_call = crash_call
+        self.action_calls = 0
+        self.initial_planning_calls = 0
+
+    def __call__(self, messages, stop_sequences=None, **kwargs):
+        self.last_input_token_count = 1
+        self.last_output_token_count = 1
+        if not stop_sequences or "<end_plan>" in stop_sequences:
+            # Initial facts and plan are single-message prompts; updates include the memory
+            self.initial_planning_calls += len(messages) == 1
+            return ChatMessage(role="assistant", content="1. Do the task")
+
+        self.action_calls += 1
+        if self.action_calls == self.crash_call:
+            raise KeyboardInterrupt
+        code = 'final_answer("report")' if self.action_calls == self.final_call else f"print({self.action_calls})"
+        return ChatMessage(role="assistant", content=f"Thought: step\nCode:\n```py\n{code}\n```<end_code>")
+
+
+class CodeScriptModel(ScriptedModel):
+    """Stand-in model that answers its action calls with the given code snippets in order."""
+
+    def __init__(self, codes, crash_call: int = None):
+        super().__init__(final_call=0, crash_call=crash_call)
+        self.codes = codes
+
+    def __call__(self, messages, stop_sequences=None, **kwargs):
+        response = super().__call__(messages, stop_sequences, **kwargs)
+        if stop_sequences and "<end_plan>" not in stop_sequences:
+            response.content = f"Thought: step\nCode:\n```py\n{self.codes[self.action_calls - 1]}\n```<end_code>"
+        return response
+
+
+class FinalAnswerCrashModel(ScriptedModel):
+    """Stand-in model that never finishes on its own and crashes in the forced final-answer call until `crash` is unset."""
+
+    crash = True
+
+    def __call__(self, messages, stop_sequences=None, **kwargs):
+        if not stop_sequences and "please provide an answer" in messages[-1]["content"][0]["text"]:
+            if self.crash:
+                raise KeyboardInterrupt
+            return ChatMessage(role="assistant", content="forced report")
+        return super().__call__(messages, stop_sequences, **kwargs)
+
+
+class CachingScriptedModel(ScriptedModel):
+    """Stand-in model whose responses report OpenAI-style cached prompt tokens."""
+
+    def __call__(self, messages, stop_sequences=None, **kwargs):
+        response = super().__call__(messages, stop_sequences, **kwargs)
+        self.last_input_token_count = 2000
+        response.raw = SimpleNamespace(usage=SimpleNamespace(prompt_tokens_details=SimpleNamespace(cached_tokens=1536)))
+        return response
+
+
+class FailingModel(ScriptedModel):
+    """Stand-in model whose provider is down."""
+
+    def __call__(self, messages, stop_sequences=None, **kwargs):
+        raise RuntimeError("provider down")
+
+
+def user_message(text):
+    return {"role": "user", "content": [{"type": "text", "text": text}]}
+
+
+def make_router(fast_class=ScriptedModel, **kwargs):
+    fast, strong = fast_class(final_call=0), ScriptedModel(final_call=0)
+    fast.model_id, strong.model_id = "fast", "strong"
+    return RoutingModel(fast, strong, **kwargs)
+
+
+def route_action_steps(router, step_errors):
+    """Routes one action call per step and reports each step outcome, returning the reasons of the served calls."""
+    for error in step_errors:
+        router([user_message("next step")], stop_sequences=ACTION_STOP)
+        router.record_step(SimpleNamespace(error=error))
+    return [entry["reason"] for entry in router.route_log if not entry["failed"]]
+
+
+def make_agent(model, checkpoint, max_steps=6, managed_agents=None):
+    return ResumableCodeAgent(
+        tools=[],
+        model=model,
+        managed_agents=managed_agents,
+        planning_interval=2,
+        max_steps=max_steps,
+        step_callbacks=[checkpoint.log_steps],
+        verbosity_level=LogLevel.OFF,
+    )
+
+
+def read_log(path):
+    with open(path) as f:
+        return [(record["type"], record.get("kind")) for record in map(json.loads, f)]
+
+
+def test_resume_continues_from_last_completed_step(tmp_path):
+    model = ScriptedModel(final_call=5, crash_call=3)
+    checkpoint = RunCheckpoint(str(tmp_path))
+    with pytest.raises(KeyboardInterrupt):
+        checkpoint.run(make_agent(model, checkpoint), "Write a report", run_id="test")
+    assert model.initial_planning_calls == 2
+
+    # Resume in a fresh agent, as a new process would
+    checkpoint = RunCheckpoint(str(tmp_path))
+    agent = make_agent(model, checkpoint)
+    assert checkpoint.run(agent, "Write a report", run_id="test") == "report"
+
+    steps = agent.memory.steps
+    assert [type(step) for step in steps] == [
+        TaskStep, PlanningStep, ActionStep, ActionStep, PlanningStep, ActionStep, ActionStep
+    ]
+    assert [step.step_number for step in steps if isinstance(step, ActionStep)] == [1, 2, 3, 4]
+    assert model.initial_planning_calls == 2
+    assert read_log(checkpoint.path) == [
+        ("step", "task"), ("step", "planning"), ("step", "action"), ("step", "action"),
+        ("step", "planning"), ("step", "action"), ("step", "action"), ("final", None),
+    ]
+
+
+def test_finished_run_starts_fresh(tmp_path):
+    model = ScriptedModel(final_call=1)
+    checkpoint = RunCheckpoint(str(tmp_path))
+    checkpoint.run(make_agent(model, checkpoint), "Write a report", run_id="test")
+
+    model.final_call = 2
+    checkpoint.run(make_agent(model, checkpoint), "Write a report", run_id="test")
+    assert model.action_calls == 2
+    assert read_log(checkpoint.path) == [("step", "task"), ("step", "planning"), ("step", "action"), ("final", None)]
+
+
+def test_resume_after_max_steps_only_requests_final_answer(tmp_path):
+    model = FinalAnswerCrashModel(final_call=0)
+    checkpoint = RunCheckpoint(str(tmp_path))
+    with pytest.raises(KeyboardInterrupt):
+        checkpoint.run(make_agent(model, checkpoint, max_steps=2), "Write a report", run_id="test")
+
+    model.crash = False
+    checkpoint = RunCheckpoint(str(tmp_path))
+    assert checkpoint.run(make_agent(model, checkpoint, max_steps=2), "Write a report", run_id="test") == "forced report"
+    assert model.action_calls == 2
+    assert read_log(checkpoint.path)[-2:] == [("step", "action"), ("final", None)]
+
+
+def test_resume_rebuilds_variables_from_logged_managed_outputs(tmp_path):
+    sub_agent_model = CodeScriptModel(['final_answer("sub-agent result 1")', 'final_answer("sub-agent result 2")'])
+    manager_model = CodeScriptModel(
+        ['web_results = web_search_agent(task="find data")', 'print("step 2")', None, "final_answer(web_results)"],
+        crash_call=3,
+    )
+
+    def make_manager(checkpoint):
+        sub_agent = CodeAgent(
+            tools=[], model=sub_agent_model, name="web_search_agent", description="Searches the web.",
+            verbosity_level=LogLevel.OFF,
+        )
+        manager = make_agent(manager_model, checkpoint, managed_agents=[sub_agent])
+        checkpoint.cache_managed_agents(manager)
+        return manager
+
+    checkpoint = RunCheckpoint(str(tmp_path))
+    with pytest.raises(KeyboardInterrupt):
+        checkpoint.run(make_manager(checkpoint), "Write a report", run_id="test")
+
+    # A new process re-runs step 1's code, with the sub-agent's output served from the log
+    checkpoint = RunCheckpoint(str(tmp_path))
+    result = checkpoint.run(make_manager(checkpoint), "Write a report", run_id="test")
+    assert "sub-agent result 1" in result
+    assert sub_agent_model.action_calls == 1
+
+
+def test_managed_outputs_replay_once_on_resume(tmp_path):
+    sub_agent = SimpleNamespace(name="web_search_agent", calls=0)
+
+    def run(task):
+        sub_agent.calls += 1
+        return f"result {sub_agent.calls}"
+
+    sub_agent.run = run
+    checkpoint = RunCheckpoint(str(tmp_path))
+    checkpoint.cache_managed_agents(SimpleNamespace(managed_agents={"web_search_agent": sub_agent}))
+
+    # Retries within a run always reach the sub-agent
+    checkpoint.open("test", "Write a report", resume=False)
+    assert sub_agent.run("search") == "result 1"
+    assert sub_agent.run("search") == "result 2"
+
+    # On resume, each logged output is replayed once, in order
+    checkpoint.open("test", "Write a report", resume=True)
+    checkpoint.restore(SimpleNamespace(memory=None))
+    assert [sub_agent.run("search") for _ in range(3)] == ["result 1", "result 2", "result 3"]
+
+
+def test_log_of_another_task_is_not_resumed(tmp_path):
+    model = ScriptedModel(final_call=0, crash_call=2)
+    checkpoint = RunCheckpoint(str(tmp_path))
+    with pytest.raises(KeyboardInterrupt):
+        checkpoint.run(make_agent(model, checkpoint), "Research AI & ML", run_id="AI & ML")
+
+    checkpoint.open("AI ML", "Research AI ML", resume=True)
+    assert checkpoint.records == []
+
+
+def test_checkpoint_log_names(tmp_path):
+    checkpoint = RunCheckpoint(str(tmp_path))
+    assert checkpoint.open("Énergie éolienne", "Write a report") == str(tmp_path / "énergie-éolienne.jsonl")
+    with pytest.raises(ValueError):
+        checkpoint.open("!!!", "Write a report")
+
+
+@pytest.mark.parametrize(
+    "router_kwargs, text, stop_sequences, expected",
+    [
+        ({}, "next step", ACTION_STOP, ("fast", "routine")),
+        ({}, "next step", None, ("strong", "planning")),
+        ({}, "next step", ["<end_plan>"], ("strong", "planning")),
+        ({}, "Error:\nboom\nNow let's retry: take care", ACTION_STOP, ("strong", "after_error")),
+        ({"max_fast_prompt_chars": 10}, "x" * 20, ACTION_STOP, ("strong", "prompt_size")),
+        ({"route_fn": lambda messages, stop_sequences: "strong"}, "next step", ACTION_STOP, ("strong", "custom")),
+        ({"route_fn": lambda messages, stop_sequences: None}, "next step", ACTION_STOP, ("fast", "routine")),
+    ],
+)
+def test_router_rules(router_kwargs, text, stop_sequences, expected):
+    router = make_router(**router_kwargs)
+    router([user_message(text)], stop_sequences=stop_sequences)
+    entry = router.route_log[-1]
+    assert (entry["route"], entry["reason"]) == expected
+    assert entry["model_id"] == router.last_model_id == expected[0]
+
+
+def test_router_retries_on_strong_after_fast_failure():
+    router = make_router(fast_class=FailingModel)
+    response = router([user_message("next step")], stop_sequences=ACTION_STOP)
+    assert "print(1)" in response.content
+    assert [(entry["route"], entry["reason"], entry["failed"]) for entry in router.route_log] == [
+        ("fast", "routine", True), ("strong", "fast_failed", False)
+    ]
+    assert router.route_stats["fast"]["errors"] == 1
+
+
+def test_router_keeps_fast_route_off_while_provider_is_down():
+    router = make_router(fast_class=FailingModel)
+    assert route_action_steps(router, [None] * 7) == ["fast_failed"] * 3 + ["fast_unreliable"] * 4
+
+
+def test_router_recovers_once_failed_steps_leave_window():
+    router = make_router(max_fast_failures=2, outcome_window=3)
+    reasons = route_action_steps(router, ["bad code", "bad code", None, None, None])
+    assert reasons == ["routine", "routine", "fast_unreliable", "fast_unreliable", "routine"]
+    assert router.route_stats["fast"]["failed_steps"] == 2
+
+
+def test_router_stats_table():
+    router = make_router()
+    router([user_message("next step")], stop_sequences=ACTION_STOP)
+    router([user_message("next step")], stop_sequences=ACTION_STOP)
+    router([user_message("plan")])
+    table = router.stats_table()
+    assert table.loc["fast", "calls"] == 2
+    assert table.loc["strong", "calls"] == 1
+    assert table.loc["fast", "input_tokens"] == 2
+    assert table.loc["fast", "avg_seconds"] == table.loc["fast", "seconds"] / 2
+
+
+class StandInPages:
+    """Stand-in for `fetch_markdown` whose downloads of URLs in `blocked` wait until `release` is set."""
+
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.fetched = []
+
+    def __call__(self, url, timeout=None):
+        self.fetched.append(url)
+        if url in self.blocked:
+            self.started.set()
+            self.release.wait(5)
+        if "broken" in url:
+            raise RequestException(f"cannot reach {url}")
+        return f"page {url}"
+
+
+@pytest.fixture
+def pages(monkeypatch):
+    stand_in = StandInPages(blocked={"https://slow.example"})
+    # run_path returns a copy of the script's globals; patch the ones its functions actually use
+    monkeypatch.setitem(PagePrefetcher.prefetch.__globals__, "fetch_markdown", stand_in)
+    yield stand_in
+    stand_in.release.set()
+
+
+def finish_fetches(prefetcher):
+    prefetcher.executor.shutdown(wait=True)
+
+
+def test_prefetcher_serves_finished_pages(pages):
+    prefetcher = PagePrefetcher()
+    prefetcher.prefetch(["https://a.example", "https://b.example"])
+    finish_fetches(prefetcher)
+    assert prefetcher.pop("https://a.example") == "page https://a.example"
+    assert prefetcher.pop("https://c.example") is None
+    assert prefetcher.stats == {"scheduled": 2, "hits": 1, "misses": 1, "evicted": 0}
+
+
+def test_prefetcher_cancels_queued_fetch_on_pop(pages):
+    prefetcher = PagePrefetcher(max_workers=1)
+    prefetcher.prefetch(["https://slow.example", "https://queued.example"])
+    pages.started.wait(5)
+    assert prefetcher.pop("https://queued.example") is None
+    pages.release.set()
+    finish_fetches(prefetcher)
+    assert pages.fetched == ["https://slow.example"]
+    assert prefetcher.stats["misses"] == 1
+
+
+def test_prefetcher_waits_for_running_fetch(pages):
+    prefetcher = PagePrefetcher()
+    prefetcher.prefetch(["https://slow.example"])
+    pages.started.wait(5)
+    threading.Timer(0.05, pages.release.set).start()
+    assert prefetcher.pop("https://slow.example") == "page https://slow.example"
+    assert prefetcher.stats["hits"] == 1
+
+
+def test_prefetcher_drops_failed_fetches(pages):
+    prefetcher = PagePrefetcher()
+    prefetcher.prefetch(["https://broken.example"])
+    finish_fetches(prefetcher)
+    assert "https://broken.example" not in prefetcher.pages
+    assert prefetcher.pop("https://broken.example") is None
+
+
+def test_prefetcher_evicts_oldest_pages_past_memory_cap(pages):
+    prefetcher = PagePrefetcher(max_workers=1, max_buffer_chars=50)
+    prefetcher.prefetch(["https://a.example", "https://b.example", "https://c.example"])
+    finish_fetches(prefetcher)
+    assert list(prefetcher.pages) == ["https://b.example", "https://c.example"]
+    assert prefetcher.buffered_chars == 2 * len("page https://b.example")
+    assert prefetcher.stats["evicted"] == 1
+
+
+def test_prefetcher_clear_evicts_everything(pages):
+    prefetcher = PagePrefetcher(max_workers=1)
+    prefetcher.prefetch(["https://a.example", "https://slow.example", "https://queued.example"])
+    # With one worker, the first page is buffered before the slow one starts
+    pages.started.wait(5)
+    prefetcher.clear()
+    pages.release.set()
+    finish_fetches(prefetcher)
+    assert not prefetcher.pages
+    assert prefetcher.buffered_chars == 0
+    assert "https://queued.example" not in pages.fetched
+
+
+def test_prefetcher_shutdown_drops_queued_fetches(pages):
+    prefetcher = PagePrefetcher(max_workers=1)
+    prefetcher.prefetch(["https://slow.example", "https://queued.example"])
+    pages.started.wait(5)
+    prefetcher.shutdown()
+    pages.release.set()
+    finish_fetches(prefetcher)
+    assert not prefetcher.pages
+    assert pages.fetched == ["https://slow.example"]
+
+
+def test_search_tool_prefetches_top_result_urls():
+    scheduled = []
+    search_tool = PrefetchingSearchTool(SimpleNamespace(prefetch=scheduled.extend), top_k=2)
+    search_tool.ddgs = SimpleNamespace(text=lambda query, max_results: [
+        {"title": "Defence [2025] outlook", "href": "https://news.example/defence?id=1", "body": "Budgets grow."},
+        {"title": "Arms race", "href": "https://en.wikipedia.org/wiki/Arms_race_(disambiguation)", "body": "See (also)."},
+        {"title": "Third", "href": "https://third.example", "body": "Not prefetched."},
+    ])
+    results = search_tool.forward("defence industry")
+    assert results.startswith("## Search Results")
+    assert scheduled == [
+        "https://news.example/defence?id=1", "https://en.wikipedia.org/wiki/Arms_race_(disambiguation)"
+    ]
+
+
+def test_prompt_cache_canonicalizes_only_leading_system_messages():
+    messages = [
+        {"role": "system", "content": [{"type": "text", "text": "You are an agent.  \r\n\n\n\nTools:\n- search  "}]},
+        {"role": "system", "content": "Managed agents:  \n\n\n\n- web  "},
+        {"role": "user", "content": [{"type": "text", "text": "Task  \n\n\n\n"}, {"type": "image", "image": "chart"}]},
+        {"role": "system", "content": "Late  \n\n\n\nnote"},
+    ]
+    model = ScriptedModel(final_call=0)
+    cache_model = PromptCacheModel(model)
+    canonical = cache_model._canonical_messages(messages)
+
+    assert canonical[0]["content"] == [{"type": "text", "text": "You are an agent.\n\nTools:\n- search"}]
+    assert canonical[1]["content"] == "Managed agents:\n\n- web"
+    assert canonical[2:] == messages[2:]
+    assert [message["role"] for message in canonical] == ["system", "system", "user", "system"]
+    assert messages[0]["content"][0]["text"].endswith("search  ")
+
+
+def test_prompt_cache_reports_cached_tokens():
+    cache_model = PromptCacheModel(CachingScriptedModel(final_call=0))
+    cache_model([user_message("next step")], stop_sequences=ACTION_STOP)
+    uncached_model = PromptCacheModel(ScriptedModel(final_call=0))
+    uncached_model([user_message("next step")], stop_sequences=ACTION_STOP)
+
+    row = cache_model.cache_table().iloc[0]
+    assert (row["input_tokens"], row["cached_tokens"], row["uncached_tokens"]) == (2000, 1536, 464)
+    assert row["hit_rate"] == 1536 / 2000
+    assert uncached_model.cache_log[0]["cached_tokens"] == 0
+
+
+def test_prompt_cache_rows_name_run_step_kind_and_model():
+    model = CachingScriptedModel(final_call=1)
+    model.model_id = "gpt-4o-mini"
+    cache_model = PromptCacheModel(model)
+    agent = CodeAgent(
+        tools=[], model=cache_model, max_steps=1, step_callbacks=[cache_model.record_step], verbosity_level=LogLevel.OFF
+    )
+    agent.run("First task")
+    agent.run("Second task")  # Runs out of steps and forces a final answer
+
+    table = cache_model.cache_table()
+    assert table[["run", "step", "kind", "model_id"]].values.tolist() == [
+        [1, 1, "action", "gpt-4o-mini"],
+        [2, 1, "action", "gpt-4o-mini"],
+        [2, 2, "final_answer", "gpt-4o-mini"],
+    ]